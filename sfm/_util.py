@@ -0,0 +1,75 @@
+"""
+Helpers shared by the inference modules.
+"""
+import numpy as np
+
+from sfm.model import SFM
+
+
+def check_vfi_inputs(sfm: SFM, w_exo: dict, target_nodes=None):
+    """
+    Check the inputs of (partial) vanilla forward inference,
+    and return the target nodes as a set, if they are given.
+    """
+    assert sfm.is_directed_acyclic_graph, \
+        "Forward inference is only allowed in directed acyclic graphs"
+    # dict keys support set comparisons directly, so no new set is built
+    assert len(w_exo) == len(sfm.exo_nodes) and sfm.exo_nodes <= w_exo.keys(),\
+        "w_exo must contain all exogenous nodes for vanilla forward inference"
+    if target_nodes is None:
+        return None
+    if not isinstance(target_nodes, (set, frozenset)):
+        target_nodes = set(target_nodes)
+    assert not target_nodes.difference(sfm.graph.nodes),\
+        "all target nodes should be in the SFM"
+    return target_nodes
+
+
+def choose_batch_plan(sfm: SFM, w_exo: dict, batched, n_nodes: int, min_batch_size: int):
+    """
+    Return the SFM's `_batch_plan` if inference over `n_nodes` endo-nodes
+    should be batched, or None if it should evaluate nodes one by one.
+
+    With `batched=None`, batches are used when all structural functions support them,
+    there are at least `min_batch_size` nodes per batch on average,
+    and all exo-node values are real numbers.
+    """
+    if batched is False:
+        return None
+    plan = sfm._batch_plan
+    if plan is None:
+        if batched:
+            raise ValueError("batched inference requires all structural functions to support batch_call")
+        return None
+    if batched:
+        return plan
+    # other values (e.g. complex numbers or Fractions)
+    # are left to the structural functions themselves
+    if n_nodes >= min_batch_size * len(plan) and np.asarray(list(w_exo.values())).dtype.kind in "biuf":
+        return plan
+    return None
+
+
+def exo_array(sfm: SFM, w_exo: dict, plan: list) -> np.ndarray:
+    """
+    Create an array assignment for batched inference with the exo-node values,
+    with a data type that also fits the outputs of all batches in the plan.
+    """
+    idx = sfm._idx
+    exo_vals = np.array(list(w_exo.values()))
+    dtype = np.result_type(exo_vals, *(cls.dtype for _, _, cls, _ in plan))
+    # the extra last entry is the padding slot read by short rows of a batch
+    w_arr = np.zeros(len(sfm.nodes) + 1, dtype=dtype)
+    w_arr[[idx[u] for u in w_exo]] = exo_vals
+    return w_arr
+
+
+def report(result, sfm: SFM, count: int, name: str, verbose: bool, return_stats: bool):
+    """
+    Print and/or attach the evaluation count of an inference call to its result.
+    """
+    if verbose:
+        print(f"{name} evaluations: {count}/{len(sfm.endo_nodes)}")
+    if return_stats:
+        return result, {"evaluations": count, "endo_total": len(sfm.endo_nodes)}
+    return result
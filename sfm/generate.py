@@ -7,31 +7,247 @@ import networkx as nx
 from matplotlib import pyplot as plt
 from matplotlib import colors as mcolors
 from functools import partial
+from operator import mul
 
 
 from sfm.model import SFM
 
 
-class RandomLinear:
+# below this many parents, structural functions are evaluated in plain Python
+# because the overhead of a NumPy call outweighs the arithmetic
+SMALL_FANIN = 8
+
+# with at most this many parents, the random structural functions generate
+# their own code with all loops unrolled
+UNROLL_FANIN = 4
+
+# integer congruences only gain from a NumPy dot product above this many parents,
+# since gathering the inputs into an array costs as much as the Python sum below it
+LARGE_FANIN = 512
+
+
+def _lin_eval(a, b, x):
+    """
+    Evaluate `a1 x1 + a2 x2 + ... + b` with a scalar loop.
+
+    `a` and `x` are sequences of Python floats;
+    iterating over them avoids the boxing of NumPy scalars.
+    """
+    s = 0.0
+    for i in range(len(x)):
+        s += a[i] * x[i]
+    return s + b
+
+
+def _compile_unrolled(name, args: dict, nodes, body: list):
+    """
+    Compile the functions `name(w)` and `name_args(x)` with the given body lines,
+    as closures over the variables in `args` ({variable name: value}).
+
+    The body reads the value of the i-th parent node in `nodes` as `x{i}`,
+    which `name(w)` looks up in the {node: value} dict w,
+    and `name_args(x)` unpacks from the sequence x of parent values.
+
+    Used to generate structural functions with unrolled loops,
+    where each weight and parent node is a variable of its own.
+    """
+    args = {**args, **{f"n{i}": node for i, node in enumerate(nodes)}}
+    lookup = [f"x{i} = w[n{i}]" for i in range(len(nodes))]
+    unpack = ["".join(f"x{i}, " for i in range(len(nodes))) + "= x"] if nodes else []
+    src = (f"def _make({', '.join(args)}):\n"
+           f"    def {name}(w):\n"
+           + "".join(f"        {line}\n" for line in lookup + body)
+           + f"    def {name}_args(x):\n"
+           + "".join(f"        {line}\n" for line in unpack + body)
+           + f"    return {name}, {name}_args\n")
+    namespace = {}
+    exec(src, namespace)
+    return namespace["_make"](**args)
+
+
+def _congruence_fits_int64(n, m):
+    """
+    Whether `a1 x1 + ... + an xn + c` fits in an int64
+    for weights and inputs reduced modulo m.
+    """
+    return n * (m - 1) ** 2 + m < 2 ** 63
+
+
+def _quad_eval(A, b, c, x):
+    """
+    Evaluate `x^T A x + b x + c` with a scalar loop.
+
+    `A` is the row-major flattened (n * n) weight matrix
+    as a sequence of Python floats, so no 2D indexing is needed.
+    """
+    n = len(x)
+    s = c
+    for i in range(n):
+        xi = x[i]
+        s += b[i] * xi
+        row = i * n
+        for j in range(n):
+            s += xi * A[row + j] * x[j]
+    return s
+
+
+def _split_batch(parent_lists, sizes, weights, make):
+    """
+    Create one function per list of parent nodes with `make(nodes, w)`,
+    where `w` is the next slice of the flat `weights`, with the given size.
+
+    Used by `random_batch` to draw the weights of all functions at once.
+    """
+    functions = []
+    start = 0
+    for nodes, size in zip(parent_lists, sizes):
+        functions.append(make(nodes, weights[start:start + size]))
+        start += size
+    return functions
+
+
+class _UnrolledFunction:
+    """
+    Base class of the random structural functions
+    that generate their own code for a few parents.
+
+    Subclasses implement `_compile`, which returns the pair of functions
+    from `_compile_unrolled`, and `_call_args` for a larger fan-in.
+    """
+
+    def _init_unrolled(self):
+        # generated code for a few parents, taking a dict and a sequence
+        if len(self.nodes) <= UNROLL_FANIN:
+            self._unrolled, self._unrolled_args = self._compile()
+        else:
+            self._unrolled = self._unrolled_args = None
+
+    def call_args(self, x):
+        """
+        Evaluate the function on a sequence of parent values
+        in the order of `self.nodes`, without a {node: value} dict.
+        """
+        if self._unrolled_args is not None:
+            return self._unrolled_args(x)
+        return self._call_args(x)
+
+    def __getstate__(self):
+        # generated code can't be pickled, so it is compiled again when unpickling
+        state = self.__dict__.copy()
+        state["_unrolled"] = state["_unrolled_args"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_unrolled()
+
+
+class RandomLinear(_UnrolledFunction):
     """
     Generate a random linear function
     with weights and bias initialized from unit normal N(0, 1).
     The input is a {node: value} dictionary.
+
+    Many RandomLinear functions can be evaluated at once
+    with `RandomLinear.stack` and `RandomLinear.batch_call`.
     """
-    def __init__(self, nodes):
+    dtype = np.float64  # output data type of batch_call
+
+    def __init__(self, nodes, a=None, b=None):
         self.nodes = tuple(nodes)
         n = len(self.nodes)
-        self.a = np.random.randn(n)  # weights for first-order terms
-        self.b = np.random.randn()  # constant bias
+        # weights for first-order terms, drawn at random unless given
+        self.a = np.random.randn(n) if a is None else np.asarray(a, dtype=np.float64)
+        # constant bias
+        self.b = float(np.random.randn() if b is None else b)
+        # weights as Python floats for the scalar path
+        self._a = tuple(self.a.tolist())
+        self._init_unrolled()
 
     def __call__(self, w: dict) -> float:
-        # convert parent assignment into a vector
-        x = np.array([w[node] for node in self.nodes])
-        return self.a @ x + self.b
+        # the terms are always accumulated one by one in the order of self.nodes
+        # (no BLAS dot product), so batch_call gives bitwise identical results
+        if self._unrolled is not None:
+            return self._unrolled(w)
+        return _lin_eval(self._a, self.b, [w[node] for node in self.nodes])
+
+    def _call_args(self, x) -> float:
+        return _lin_eval(self._a, self.b, x)
+
+    def _compile(self):
+        # generate `0.0 + a0 * x0 + a1 * x1 + ... + b`,
+        # which adds the terms in the same order as _lin_eval
+        args = {"b": self.b}
+        terms = ["0.0"]
+        for i in range(len(self.nodes)):
+            args[f"a{i}"] = self._a[i]
+            terms.append(f"a{i} * x{i}")
+        terms.append("b")
+        return _compile_unrolled("linear", args, self.nodes, ["return " + " + ".join(terms)])
+
+    @classmethod
+    def random_batch(cls, parent_lists, rng: np.random.Generator):
+        """
+        Create one random linear function per list of parent nodes,
+        drawing the weights of all functions in a single call to `rng`.
+        """
+        sizes = [len(nodes) + 1 for nodes in parent_lists]
+        weights = rng.standard_normal(sum(sizes))
+        return _split_batch(parent_lists, sizes, weights, lambda nodes, w: cls(nodes, a=w[:-1], b=w[-1]))
 
+    @staticmethod
+    def stack(functions):
+        """
+        Stack the weights of RandomLinear functions.
 
-class RandomQuadratic:
-    def __init__(self, nodes):
+        Parameters
+        ----------
+        functions: list
+            List of G RandomLinear functions with at most K parent nodes.
+
+        Returns
+        -------
+        tuple
+            Weights of shape (G, K) and biases of shape (G,), used by `batch_call`.
+            Functions with fewer than K parents are padded with zero weights.
+        """
+        k = max(len(f.nodes) for f in functions)
+        a = np.zeros((len(functions), k), dtype=np.float64)
+        for g, f in enumerate(functions):
+            a[g, :len(f.a)] = f.a
+        b = np.array([f.b for f in functions], dtype=np.float64)
+        return a, b
+
+    @staticmethod
+    def batch_call(weights, x: np.ndarray) -> np.ndarray:
+        """
+        Evaluate G stacked RandomLinear functions at once.
+
+        Parameters
+        ----------
+        weights: tuple
+            The output of `RandomLinear.stack`.
+
+        x: np.ndarray
+            Parent values of shape (G, K),
+            where row g follows the order of the g-th function's nodes.
+            Padded entries must be 0.
+
+        Returns
+        -------
+        np.ndarray
+            The G outputs.
+        """
+        a, b = weights
+        s = np.zeros(len(b))
+        # accumulate term by term, in the same order as _lin_eval
+        for k in range(a.shape[1]):
+            s += a[:, k] * x[:, k]
+        return s + b
+
+
+class RandomQuadratic(_UnrolledFunction):
+    def __init__(self, nodes, A=None, b=None, c=None):
         """
         A quadratic function that takes in a dictionary of node-float mappings,
         and returns a float.
@@ -53,12 +269,33 @@ class RandomQuadratic:
         ----------
         nodes: list
             List of parent nodes
+
+        A: np.ndarray, optional
+            Weights for second-order terms, of shape (n, n).
+            Randomly initialized if not given, and so are `b` and `c`.
+
+        b: np.ndarray, optional
+            Weights for first-order terms, of shape (n,).
+
+        c: float, optional
+            Constant bias.
         """
         self.nodes = tuple(nodes)
         n = len(self.nodes)
-        self.A = np.random.randn(n, n)  # weights for second-order terms
-        self.b = np.random.randn(n)     # weights for first-order terms
-        self.c = np.random.randn()      # constant bias
+        # weights for second-order terms
+        self.A = np.random.randn(n, n) if A is None else np.ascontiguousarray(A, dtype=np.float64)
+        # weights for first-order terms
+        self.b = np.random.randn(n) if b is None else np.ascontiguousarray(b, dtype=np.float64)
+        # constant bias
+        self.c = float(np.random.randn() if c is None else c)
+        # weights as Python floats for the scalar path,
+        # with A flattened in row-major order
+        self._A = tuple(self.A.ravel().tolist())
+        self._b = tuple(self.b.tolist())
+        self._init_unrolled()
+        # preallocated buffers for x and A x, filled in-place on every call
+        self._x = np.empty(n, dtype=np.float64)
+        self._Ax = np.empty(n, dtype=np.float64)
 
     def __call__(self, w: dict) -> float:
         """
@@ -74,13 +311,54 @@ class RandomQuadratic:
         float
             The computed result as a floating point number.
         """
-        # convert parent assignment into a vector
-        x = np.array([w[node] for node in self.nodes])
-        return x.T @ self.A @ x + self.b @ x + self.c
+        if self._unrolled is not None:
+            return self._unrolled(w)
+        return self._call_args([w[node] for node in self.nodes])
+
+    def _call_args(self, x) -> float:
+        if len(x) < SMALL_FANIN:
+            # for a handful of parents, NumPy call overhead dominates;
+            # unroll the sums in plain Python instead
+            return _quad_eval(self._A, self._b, self.c, x)
+        # copy the parent values into the preallocated vector
+        x_arr = self._x
+        x_arr[:] = x
+        np.dot(self.A, x_arr, out=self._Ax)
+        return float(x_arr @ self._Ax) + float(self.b @ x_arr) + self.c
+
+    def _compile(self):
+        # generate `c + b0 * x0 + x0 * A0_0 * x0 + x0 * A0_1 * x1 + ... `,
+        # which adds the terms in the same order as _quad_eval
+        n = len(self.nodes)
+        args = {"c": self.c}
+        terms = ["c"]
+        for i in range(n):
+            args[f"b{i}"] = self._b[i]
+            terms.append(f"b{i} * x{i}")
+            for j in range(n):
+                args[f"A{i}_{j}"] = self._A[i * n + j]
+                terms.append(f"x{i} * A{i}_{j} * x{j}")
+        return _compile_unrolled("quadratic", args, self.nodes, ["return " + " + ".join(terms)])
+
+    @classmethod
+    def random_batch(cls, parent_lists, rng: np.random.Generator):
+        """
+        Create one random quadratic function per list of parent nodes,
+        drawing the weights of all functions in a single call to `rng`.
+        """
+        def make(nodes, w):
+            n = len(nodes)
+            return cls(nodes, A=w[:n * n].reshape(n, n), b=w[n * n:-1], c=w[-1])
+
+        sizes = [len(nodes) ** 2 + len(nodes) + 1 for nodes in parent_lists]
+        weights = rng.standard_normal(sum(sizes))
+        return _split_batch(parent_lists, sizes, weights, make)
 
 
-class RandomCongruence:
-    def __init__(self, nodes, m):
+class RandomCongruence(_UnrolledFunction):
+    dtype = np.int64  # output data type of batch_call
+
+    def __init__(self, nodes, m, a=None, c=None):
         """
         A linear congruence function that takes in a {node: int value} dictionary
         and returns an integer.
@@ -89,6 +367,9 @@ class RandomCongruence:
 
         The weights are randomly initialized as integers from 1 to m-1 inclusive.
 
+        Many RandomCongruence functions can be evaluated at once
+        with `RandomCongruence.stack` and `RandomCongruence.batch_call`.
+
         Parameters
         ----------
         nodes: list
@@ -96,18 +377,133 @@ class RandomCongruence:
 
         m: int
             The modulo/divisor parameter m in "output mod m".
+
+        a: list, optional
+            Integer weights, one per parent node, reduced mod m.
+            Randomly initialized if not given, and so is `c`.
+
+        c: int, optional
+            Integer constant, reduced mod m.
         """
         self.nodes = tuple(nodes)
         self.m = int(m)
         n = len(self.nodes)
         # weights are also random integers from 0 to m-1 inclusive
-        self.a = tuple(int(a) for a in np.random.randint(1, m, size=n))
-        self.c = int(np.random.randint(1, m))
+        if a is None:
+            a = np.random.randint(1, m, size=n)
+        if c is None:
+            c = np.random.randint(1, m)
+        # reduce given weights mod m, which keeps integer outputs the same
+        # and bounds every product by (m-1)^2 for the int64 paths
+        self.a = tuple(int(ai) % self.m for ai in a)
+        self.c = int(c) % self.m
+        # weights as an int64 vector for a single dot product
+        # when the fan-in is very large and the sum can't overflow
+        self._a = np.array(self.a, dtype=np.int64)
+        self._int64_safe = _congruence_fits_int64(n, self.m)
+        self._init_unrolled()
 
     def __call__(self, w: dict) -> int:
+        if self._unrolled is not None:
+            return self._unrolled(w)
         x = [w[node] for node in self.nodes]
-        s = sum(a*value for a, value in zip(self.a, x)) + self.c
-        return s % self.m
+        if len(x) < LARGE_FANIN or not self._int64_safe:
+            # same as _call_args, inlined to save a method call
+            return (sum(map(mul, self.a, x)) + self.c) % self.m
+        return self._call_args(x)
+
+    def _call_args(self, x) -> int:
+        if len(x) >= LARGE_FANIN and self._int64_safe:
+            m = self.m
+            # reduce the inputs first so that no product exceeds (m-1)^2;
+            # for integers this keeps the result exact, whatever their size
+            x_mod = [v % m for v in x]
+            if all(isinstance(v, (int, np.integer)) for v in x_mod):
+                return int((self._a @ np.array(x_mod, dtype=np.int64) + self.c) % m)
+        # Python ints never overflow, and other values (e.g. floats)
+        # are computed the same way as for a small fan-in
+        return (sum(map(mul, self.a, x)) + self.c) % self.m
+
+    def _compile(self):
+        # generate `(a0 * x0 + a1 * x1 + ... + c) % m` with Python ints
+        args = {"c": self.c, "m": self.m}
+        terms = []
+        for i in range(len(self.nodes)):
+            args[f"a{i}"] = self.a[i]
+            terms.append(f"a{i} * x{i}")
+        terms.append("c")
+        return _compile_unrolled("congruence", args, self.nodes, ["return (" + " + ".join(terms) + ") % m"])
+
+    @staticmethod
+    def stack(functions):
+        """
+        Stack the weights of RandomCongruence functions.
+
+        Parameters
+        ----------
+        functions: list
+            List of G RandomCongruence functions with at most K parent nodes.
+
+        Returns
+        -------
+        tuple
+            Weights of shape (G, K), constants of shape (G,)
+            and divisors of shape (G,), used by `batch_call`.
+            Functions with fewer than K parents are padded with zero weights.
+            They are int64 arrays if no sum can overflow,
+            otherwise object arrays of Python ints.
+        """
+        k = max(len(f.nodes) for f in functions)
+        m_max = max(f.m for f in functions)
+        dtype = np.int64 if _congruence_fits_int64(k, m_max) else object
+        a = np.zeros((len(functions), k), dtype=dtype)
+        for g, f in enumerate(functions):
+            a[g, :len(f.a)] = f.a
+        c = np.array([f.c for f in functions], dtype=dtype)
+        m = np.array([f.m for f in functions], dtype=dtype)
+        return a, c, m
+
+    @staticmethod
+    def batch_call(weights, x: np.ndarray) -> np.ndarray:
+        """
+        Evaluate G stacked RandomCongruence functions at once.
+
+        Parameters
+        ----------
+        weights: tuple
+            The output of `RandomCongruence.stack`.
+
+        x: np.ndarray
+            Parent values of shape (G, K),
+            where row g follows the order of the g-th function's nodes.
+            Padded entries must be 0.
+
+        Returns
+        -------
+        np.ndarray
+            The G outputs.
+        """
+        a, c, m = weights
+        if x.dtype.kind in "iu":
+            # reduce integer inputs first so that no product exceeds (m-1)^2
+            x = x % m[:, None]
+            return ((a * x).sum(axis=1) + c) % m
+        # other inputs (e.g. floats) can't be reduced without changing the result;
+        # accumulate them term by term, in the same order as the per-node path
+        s = np.zeros(len(c), dtype=np.result_type(a, x))
+        for k in range(a.shape[1]):
+            s += a[:, k] * x[:, k]
+        return (s + c) % m
+
+    @classmethod
+    def random_batch(cls, parent_lists, rng: np.random.Generator, m):
+        """
+        Create one random linear congruence per list of parent nodes,
+        drawing the weights of all functions in a single call to `rng`.
+        """
+        sizes = [len(nodes) + 1 for nodes in parent_lists]
+        weights = rng.integers(1, m, size=sum(sizes)).tolist()
+        return _split_batch(parent_lists, sizes, weights, lambda nodes, w: cls(nodes, m, a=w[:-1], c=w[-1]))
 
 
 def undirected_to_dag(G: nx.Graph, order=None):
@@ -121,11 +517,8 @@ def undirected_to_dag(G: nx.Graph, order=None):
     if order is None:
         order = np.random.permutation(G.nodes)
     order_dict = {x: i for i, x in enumerate(order)}
-    for u, v in G.edges:
-        if order_dict[u] < order_dict[v]:
-            G2.add_edge(u, v)
-        else:
-            G2.add_edge(v, u)
+    # insert all edges with one bulk call, pointing from earlier to later nodes
+    G2.add_edges_from((u, v) if order_dict[u] < order_dict[v] else (v, u) for u, v in G.edges)
     return G2
 
 
@@ -158,16 +551,107 @@ def random_dag(n, p):
     return undirected_to_dag(nx.fast_gnp_random_graph(n, p))
 
 
+def random_dag_fast(n, p):
+    """
+    Generate a random DAG with the same distribution as `random_dag`,
+    sampling the edges with NumPy in a single pass.
+
+    Each of the n(n-1)/2 pairs of nodes is connected with probability `p`,
+    and edges point from earlier to later nodes in a random permutation.
+    For dense graphs, every pair is drawn at once;
+    for sparse graphs, the gaps between consecutive edges are drawn
+    from a geometric distribution (like `nx.fast_gnp_random_graph`),
+    so the cost is proportional to the number of edges.
+
+    Parameters
+    ----------
+    n: int
+        Number of nodes
+
+    p: float
+        Probability of an edge existing between any 2 nodes.
+        Between 0 and 1.
+
+    Returns
+    -------
+    nx.DiGraph
+        The generated DAG.
+    """
+    n_pairs = n * (n - 1) // 2
+    # k enumerates the pairs (u, v) with u < v as k = v(v-1)/2 + u
+    if p <= 0 or n_pairs == 0:
+        k = np.zeros(0, dtype=np.int64)
+    elif p >= 1:
+        k = np.arange(n_pairs, dtype=np.int64)
+    elif p > 0.2:
+        k = np.flatnonzero(np.random.random(n_pairs) < p)
+    else:
+        chunks = []
+        last = -1   # index of the last sampled pair
+        while last < n_pairs:
+            # draw a bit more than the expected number of remaining edges
+            size = int((n_pairs - last) * p * 1.1) + 16
+            k = last + np.cumsum(np.random.geometric(p, size=size))
+            chunks.append(k[k < n_pairs])
+            last = k[-1]
+        k = np.concatenate(chunks)
+    # invert k = v(v-1)/2 + u, correcting for floating point rounding
+    v = ((1 + np.sqrt(1 + 8 * k.astype(np.float64))) // 2).astype(np.int64)
+    v -= v * (v - 1) // 2 > k
+    v += (v + 1) * v // 2 <= k
+    u = k - v * (v - 1) // 2
+    # relabel nodes with a random permutation, so the topological order is random
+    perm = np.random.permutation(n)
+    G = nx.DiGraph()
+    G.add_nodes_from(range(n))
+    G.add_edges_from(zip(perm[u].tolist(), perm[v].tolist()))
+    return G
+
+
 class RandomSFM(SFM):
-    def __init__(self, n, p, function_class=RandomLinear):
-        graph = random_dag(n, p)
+    def __init__(self, n, p, function_class=RandomLinear, rng=None):
+        """
+        A random SFM over a random DAG with randomly initialized structural functions.
+
+        Parameters
+        ----------
+        n: int
+            Number of nodes
+
+        p: float
+            Probability of an edge existing between any 2 nodes.
+
+        function_class: callable
+            Creates the structural function of a node from its list of parent nodes,
+            e.g. `RandomLinear` or `partial(RandomCongruence, m=5)`.
+            If the class itself defines `random_batch` (not inherited),
+            the weights of all functions are drawn at once.
+
+        rng: np.random.Generator, optional
+            Random generator for the weights of structural functions.
+            By default, it is seeded from NumPy's global random state,
+            which also draws the graph,
+            so `np.random.seed` makes the whole SFM reproducible.
+        """
+        graph = random_dag_fast(n, p)
         super().__init__(graph=graph, domains={}, functions={})
-        for node in self.endo_nodes:
-            # get the parents of node
-            parents = list(self.graph.predecessors(node))
-            # randomly initialize structural function associated with node
-            # initialization needs to know node's parent nodes
-            self.functions[node] = function_class(parents)
+        if rng is None:
+            rng = np.random.default_rng(np.random.randint(2 ** 32, size=4, dtype=np.uint32))
+        endo_nodes = list(self.endo_nodes)
+        # get the parents of each node;
+        # initialization of structural functions needs to know node's parent nodes
+        parent_lists = [list(self.graph.predecessors(node)) for node in endo_nodes]
+        cls, kwargs = function_class, {}
+        if isinstance(function_class, partial) and not function_class.args:
+            cls, kwargs = function_class.func, function_class.keywords
+        # only trust random_batch on the class that defines it:
+        # a subclass may construct its functions differently
+        if "random_batch" in vars(cls):
+            functions = cls.random_batch(parent_lists, rng, **kwargs)
+        else:
+            functions = [function_class(parents) for parents in parent_lists]
+        # randomly initialized structural function associated with each node
+        self.functions.update(zip(endo_nodes, functions))
 
 
 def plot_dag(graph: nx.DiGraph):
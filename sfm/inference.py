@@ -2,12 +2,17 @@ import numpy as np
 import networkx as nx
 
 from sfm.model import SFM
+from sfm._util import check_vfi_inputs, choose_batch_plan, exo_array, report
 
 
 def delta_encode(w1: dict, w0: dict):
     """
     Return the node-value pairs in w1 that differ from w0.
 
+    Comparing values one by one is already as fast as converting
+    the dicts to NumPy arrays, so the vectorized version,
+    `delta_encode_arr`, takes array assignments directly.
+
     Parameters
     ----------
     w1: dict
@@ -16,7 +21,8 @@ def delta_encode(w1: dict, w0: dict):
 
     Returns
     -------
-
+    dict
+        The nodes that are new in w1 or whose values differ from w0.
     """
     w1_change = {}
     for node, new_value in w1.items():
@@ -39,12 +45,61 @@ def delta_decode(w1_change: dict, w0: dict):
 
     """
     w1 = w0.copy()
-    for node in w1_change:
-        w1[node] = w1_change[node]
+    w1.update(w1_change)
+    return w1
+
+
+def delta_encode_arr(w1: np.ndarray, w0: np.ndarray):
+    """
+    Array version of `delta_encode`.
+
+    Both assignments are arrays indexed by integer node index
+    (see `SFM.assignment_to_array`).
+
+    Parameters
+    ----------
+    w1: np.ndarray
+
+    w0: np.ndarray
+
+    Returns
+    -------
+    idx: np.ndarray
+        Integer indices of the nodes whose values differ.
+
+    vals: np.ndarray
+        The values of these nodes in w1.
+    """
+    idx = np.flatnonzero(w1 != w0)
+    return idx, w1[idx]
+
+
+def delta_decode_arr(idx: np.ndarray, vals: np.ndarray, w0: np.ndarray):
+    """
+    Array version of `delta_decode`, the inverse of `delta_encode_arr`.
+
+    Parameters
+    ----------
+    idx: np.ndarray
+
+    vals: np.ndarray
+
+    w0: np.ndarray
+
+    Returns
+    -------
+    np.ndarray
+    """
+    w1 = w0.copy()
+    w1[idx] = vals
     return w1
 
 
-def vfi(sfm: SFM, w_exo):
+# use batched evaluation only if batches have at least this many nodes on average
+MIN_BATCH_SIZE = 16
+
+
+def vfi(sfm: SFM, w_exo, batched=None):
     """
     Vanilla forward inference
 
@@ -56,15 +111,23 @@ def vfi(sfm: SFM, w_exo):
     w_exo : dict
         The assignment over all exo-nodes.
 
+    batched : bool, optional
+        Whether to evaluate endo-nodes in vectorized batches,
+        which requires all structural functions to support `batch_call`.
+        By default, batches are used when they are supported and large enough,
+        and all exo-node values are real numbers.
+
     Returns
     -------
     w : dict
         The induced complete assignment
     """
-    assert sfm.is_directed_acyclic_graph, \
-        "Forward inference is only allowed in directed acyclic graphs"
-    assert frozenset(w_exo.keys()) == sfm.exo_nodes,\
-        "w_exo must contain all exogenous nodes for non-contrastive forward inference"
+    check_vfi_inputs(sfm, w_exo)
+    plan = choose_batch_plan(sfm, w_exo, batched, len(sfm.endo_nodes), MIN_BATCH_SIZE)
+    if plan is not None:
+        return _vfi_batched(sfm, w_exo, plan)
+    # bind to locals once, instead of an attribute lookup per node
+    functions = sfm.functions
     w = w_exo.copy()    # shallow copy to initialize output assignment w
     for node in sfm.topological_order:
         if node not in w:
@@ -74,63 +137,115 @@ def vfi(sfm: SFM, w_exo):
             # this second method is slightly faster because it doesn't involve
             # creating a parent assignment dictionary every time.
             # assuming the structural function doesn't check the length of w dict.
-            w[node] = sfm.functions[node](w)
+            w[node] = functions[node](w)
     return w
 
 
-def cfi(sfm: SFM, w0: dict, w1_changed_exo: dict):
+def _vfi_batched(sfm: SFM, w_exo: dict, plan: list):
+    """
+    Vanilla forward inference over an array assignment,
+    evaluating one batch of the SFM's `_batch_plan` at a time,
+    i.e. each topological generation with one vectorized call per function class.
+    """
+    nodes = sfm.nodes
+    w_arr = exo_array(sfm, w_exo, plan)
+    for node_idx, parent_idx, cls, weights in plan:
+        w_arr[node_idx] = cls.batch_call(weights, w_arr[parent_idx])
+    w = w_exo.copy()
+    for node_idx, _, _, _ in plan:
+        w.update(zip([nodes[i] for i in node_idx], w_arr[node_idx].tolist()))
+    return w
+
+
+def cfi(sfm: SFM, w0: dict, w1_changed_exo: dict, *, verbose=False, return_stats=False):
     """
     Contrastive forward inference.
 
+    A node is only re-evaluated if the value of one of its parents
+    differs from the reference assignment w0.
+    "Changed" is decided by comparing values, not by reachability,
+    so a structural function is never called on the same parent values as in w0;
+    such nodes keep their reference value without evaluation.
+
     Parameters
     ----------
-    sfm
-    w1_changed_exo
-    w0
+    sfm : SFM
+        The structural functional model
+
+    w0 : dict
+        The reference assignment over all nodes.
+
+    w1_changed_exo : dict
+        The new values of some exo-nodes.
+        Exo-nodes that are not included keep their values in w0.
+
+    verbose : bool
+        Whether to print the number of evaluated structural functions.
+
+    return_stats : bool
+        Whether to also return evaluation statistics.
 
     Returns
     -------
+    w1 : dict
+        The induced complete assignment
 
+    stats : dict
+        Only returned if `return_stats` is True.
+        "evaluations" is the number of evaluated structural functions,
+        and "endo_total" is the number of endo-nodes.
     """
     assert sfm.is_directed_acyclic_graph, \
         "Forward inference is only allowed in directed acyclic graphs"
-    assert all(u in sfm.exo_nodes for u in w1_changed_exo), \
+    assert sfm.exo_nodes.issuperset(w1_changed_exo), \
         "All nodes in w_exo must be exogenous in the SFM"
     assert all(u in w0 for u in sfm.graph.nodes), \
         "w_ref must contain assignment over all nodes"
-    changed = {}  # node -> whether the value changes
-    for u in sfm.graph.nodes:
-        if u in w1_changed_exo and w1_changed_exo[u] != w0[u]:
-            changed[u] = True
+    nodes = sfm.nodes
+    idx = sfm._idx
+    parent_idx = sfm._parent_idx
+    topo = sfm._topo_idx.tolist()
+    last_child_pos = sfm._last_child_pos
+    functions = sfm.functions
+    # start from the reference values and only overwrite the nodes that change
+    w1 = {u: w0[u] for u in sfm.topological_order}
+    # changed[i] == 1 iff the value of the node with index i changes
+    changed = bytearray(len(nodes))
+    # topological position of the last node that may still change;
+    # it only grows when a changed node has children further down the order
+    frontier = -1
+    for u, value in w1_changed_exo.items():
+        if value != w0[u]:
+            i = idx[u]
+            changed[i] = 1
+            w1[u] = value
+            frontier = max(frontier, last_child_pos[i])
+
+    count = 0   # the number of function evaluations
+
+    # nodes after the frontier have no changed parents, so they keep their values
+    pos = 0
+    while pos <= frontier:
+        i = topo[pos]
+        pos += 1
+        # recompute node u if any of its parents have changed
+        # (exo-nodes have no parents and have already been assigned)
+        for parent in parent_idx[i]:
+            if changed[parent]:
+                break
         else:
-            changed[u] = False
-    w1 = {}
-
-    COUNT = 0   # debug: count the number of function evaluations
-
-    for u in sfm.topological_order:
-        recompute = changed[u]
-        # recompute node u if u or any of its parents have changed
-        for parent in sfm.parents(u):
-            recompute = recompute or changed[parent]
-        if recompute:
-            if sfm.is_exo_node(u):
-                w1[u] = w1_changed_exo[u]
-            else:   # u is endogenous
-                f = sfm.functions[u]
-                # w1_parent = {parent: w1[parent] for parent in sfm.parents(u)}
-                # new_val = f(w1_parent)
-                new_val = f(w1)
-                COUNT += 1
-                if new_val != w0[u]:
-                    w1[u] = new_val
-                    changed[u] = True
-                else:
-                    w1[u] = w0[u]
-        else:   # don't recompute
-            w1[u] = w0[u]
-    print(f"CFI evaluations: {COUNT}/{len(sfm.endo_nodes)}")
-    return w1
+            continue
+        u = nodes[i]
+        f = functions[u]
+        # w1_parent = {parent: w1[parent] for parent in sfm.parents(u)}
+        # new_val = f(w1_parent)
+        new_val = f(w1)
+        count += 1
+        if new_val != w0[u]:
+            w1[u] = new_val
+            changed[i] = 1
+            frontier = max(frontier, last_child_pos[i])
+    return report(w1, sfm, count, "CFI", verbose, return_stats)
 
 
 def main():
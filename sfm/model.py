@@ -1,5 +1,12 @@
+import numpy as np
 import networkx as nx
-from functools import cached_property, cache
+from functools import cached_property, partial
+
+
+def _call_with_dict(f, nodes, x):
+    # adapt a structural function that takes a {node: value} dict
+    # to a sequence of parent values
+    return f(dict(zip(nodes, x)))
 
 
 class SFM:
@@ -19,6 +26,10 @@ class SFM:
         graph
         domains
         functions
+            Maps each endo-node to its structural function,
+            which takes a {node: value} assignment and returns the node's value.
+            A structural function must only read the values of the node's parents,
+            because inference passes assignments that contain other nodes as well.
         """
         self.graph = graph
         self.domains = domains
@@ -27,28 +38,28 @@ class SFM:
     @cached_property
     def exo_nodes(self):
         """
-        Get a tuple of all exogenous nodes
+        Get a frozenset of all exogenous nodes
+
+        A frozenset (rather than a tuple) makes membership tests O(1).
         """
         return frozenset(node for node, in_degree in self.graph.in_degree() if in_degree == 0)
 
     @cached_property
     def endo_nodes(self):
         """
-        Get a tuple of all endogenous nodes
+        Get a frozenset of all endogenous nodes
         """
         return frozenset(node for node, in_degree in self.graph.in_degree() if in_degree > 0)
 
-    @cache
     def is_exo_node(self, node):
         # the node exists in M and is exogenous
         # a non-existent node returns False
-        return self.graph.has_node(node) and self.graph.in_degree(node) == 0
+        return node in self.exo_nodes
 
-    @cache
     def is_endo_node(self, node):
         # the node exists in M and is endogenous
         # a non-existent node returns False
-        return self.graph.has_node(node) and self.graph.in_degree(node) > 0
+        return node in self.endo_nodes
 
     @cached_property
     def topological_order(self):
@@ -61,13 +72,325 @@ class SFM:
         """
         return tuple(nx.topological_sort(self.graph))
 
+    @cached_property
+    def _topo_idx(self):
+        """
+        Get the topological order as an array of integer node indices.
+
+        It is computed once and shared by all inference calls,
+        e.g. partial inference masks it with the ancestors of its targets,
+        so the array is read-only.
+        """
+        idx = self._idx
+        topo_idx = np.array([idx[node] for node in self.topological_order], dtype=np.intp)
+        topo_idx.setflags(write=False)
+        return topo_idx
+
+    @cached_property
+    def _topo_pos(self):
+        """
+        Get the topological position of each node.
+
+        `_topo_pos[i]` is the index of node `SFM.nodes[i]` in `SFM.topological_order`.
+        """
+        pos = [0] * len(self.nodes)
+        for k, i in enumerate(self._topo_idx.tolist()):
+            pos[i] = k
+        return tuple(pos)
+
+    @cached_property
+    def _last_child_pos(self):
+        """
+        Get the topological position of the last child of each node.
+
+        `_last_child_pos[i]` is the largest index into `SFM.topological_order`
+        among the children of node `SFM.nodes[i]`, or -1 if it has no children.
+        """
+        pos = self._topo_pos
+        last = [-1] * len(self.nodes)
+        for i, parents in enumerate(self._parent_idx):
+            for p in parents:
+                if pos[i] > last[p]:
+                    last[p] = pos[i]
+        return tuple(last)
+
+    @cached_property
+    def _generations(self):
+        """
+        Get the topological generations as arrays of integer node indices.
+
+        Nodes in the same generation have no edges between them,
+        and all parents of a node are in earlier generations.
+        The first generation holds exactly the exo-nodes.
+        """
+        idx = self._idx
+        return [np.array([idx[node] for node in generation], dtype=np.intp)
+                for generation in nx.topological_generations(self.graph)]
+
+    @cached_property
+    def _batch_plan(self):
+        """
+        Get a schedule that evaluates all endogenous nodes in vectorized batches.
+
+        A structural function class opts in by providing
+        `stack(functions)` and `batch_call(weights, x)` (see `RandomLinear`).
+        The stacked weights are a tuple of arrays with one row per function,
+        so a subset of a batch can be evaluated by selecting rows.
+        Each topological generation is evaluated with one batch per function class,
+        so every batch only reads values computed by earlier batches.
+        Functions with fewer parents than the largest in their batch
+        read the padding slot with index `len(SFM.nodes)`, which must hold 0.
+
+        Returns
+        -------
+        list or None
+            A list of `(node_idx, parent_idx, cls, weights)` tuples in evaluation order,
+            or None if some structural function doesn't support batching.
+        """
+        nodes = self.nodes
+        plan = []
+        for generation in self._generations[1:]:
+            groups = {}
+            for i in generation.tolist():
+                f = self.functions[nodes[i]]
+                cls = type(f)
+                if not hasattr(cls, "batch_call"):
+                    return None
+                groups.setdefault(cls, []).append(nodes[i])
+            plan.extend(self._stack_batch(group, cls) for cls, group in groups.items())
+        return plan
+
+    @cached_property
+    def _batch_groups(self):
+        """
+        Group the endo-nodes whose structural functions support `batch_call`
+        by function class and number of parents.
+
+        Unlike `SFM._batch_plan`, the groups ignore dependencies between nodes,
+        so they can only be evaluated on a complete assignment.
+
+        Returns
+        -------
+        list
+            A list of `(node_idx, parent_idx, cls, weights)` tuples.
+        """
+        groups = {}
+        for node in self.nodes:
+            if self._parents[node]:
+                f = self.functions[node]
+                cls = type(f)
+                if hasattr(cls, "batch_call"):
+                    groups.setdefault((cls, len(f.nodes)), []).append(node)
+        return [self._stack_batch(nodes, cls) for (cls, k), nodes in groups.items()]
+
+    def _stack_batch(self, nodes, cls):
+        """
+        Pack the structural functions of some nodes with the same class
+        into a `(node_idx, parent_idx, cls, weights)` batch.
+
+        Rows of functions with fewer parents than the largest one
+        are padded with the index `len(SFM.nodes)`.
+        """
+        idx = self._idx
+        functions = [self.functions[node] for node in nodes]
+        node_idx = np.array([idx[node] for node in nodes], dtype=np.intp)
+        k = max(len(f.nodes) for f in functions)
+        parent_idx = np.full((len(nodes), k), len(self.nodes), dtype=np.intp)
+        for g, f in enumerate(functions):
+            # parent indices follow each function's own node order
+            parent_idx[g, :len(f.nodes)] = [idx[p] for p in f.nodes]
+        return node_idx, parent_idx, cls, cls.stack(functions)
+
     @cached_property
     def is_directed_acyclic_graph(self):
-        return nx.is_directed_acyclic_graph(self.graph)
+        # a topological order exists if and only if the graph is acyclic,
+        # so reuse the cached topological sort instead of traversing the graph again
+        try:
+            self.topological_order
+        except nx.NetworkXUnfeasible:
+            return False
+        return True
+
+    @cached_property
+    def _parents(self):
+        """
+        Map each node to a tuple of its parent nodes.
+
+        Built once, so inference loops index a plain dict
+        instead of creating a NetworkX predecessor view per node.
+        """
+        return {node: tuple(self.graph.predecessors(node)) for node in self.graph.nodes}
 
-    @cache
     def parents(self, node):
-        return frozenset(self.graph.predecessors(node))
+        """
+        Get a frozenset of the parent nodes of a node.
+
+        Inference uses the ordered tuples in `SFM._parents` instead.
+        """
+        return self._parent_sets[node]
+
+    @cached_property
+    def _parent_sets(self):
+        return {node: frozenset(parents) for node, parents in self._parents.items()}
+
+    @cached_property
+    def _positional_functions(self):
+        """
+        Map each endo-node to `(arg_nodes, f)`,
+        where `f` takes a sequence with the values of `arg_nodes` in order.
+
+        Structural functions that provide `call_args(x)` (see `RandomLinear`)
+        are used directly with their own node order;
+        other functions are wrapped to receive a {parent: value} dict.
+        """
+        positional = {}
+        for node, parents in self._parents.items():
+            if parents:
+                f = self.functions[node]
+                if hasattr(f, "call_args"):
+                    positional[node] = (f.nodes, f.call_args)
+                else:
+                    positional[node] = (parents, partial(_call_with_dict, f, parents))
+        return positional
+
+    @cached_property
+    def nodes(self):
+        """
+        Get a tuple of all nodes.
+
+        The position of a node in this tuple is its integer index,
+        which is used for array-based assignments.
+        """
+        return tuple(self.graph.nodes)
+
+    @cached_property
+    def _idx(self):
+        """
+        Map each node to its integer index.
+        """
+        return {node: i for i, node in enumerate(self.nodes)}
+
+    @cached_property
+    def _parent_idx(self):
+        """
+        Get the integer indices of each node's parents.
+
+        `_parent_idx[i]` is a tuple holding the indices of
+        the parents of node `SFM.nodes[i]`, in the order of `SFM.parents`.
+        Plain Python ints are fastest for scalar loops;
+        see `SFM.parent_csr` for the array version.
+        """
+        idx = self._idx
+        return tuple(tuple(idx[p] for p in self._parents[node]) for node in self.nodes)
+
+    @cached_property
+    def parent_csr(self):
+        """
+        Get the parents of all nodes in compressed sparse row (CSR) layout.
+
+        Nodes are identified by their integer index (see `SFM.nodes`).
+        Like the other graph-derived properties,
+        it is computed once and shared by all inference calls,
+        so the arrays are read-only.
+
+        Returns
+        -------
+        ptr: np.ndarray
+            Offsets of shape (number of nodes + 1,).
+
+        flat: np.ndarray
+            Concatenated parent indices; the parents of node `SFM.nodes[i]`
+            are `flat[ptr[i]:ptr[i+1]]`, in the order of `SFM.parents`.
+        """
+        sizes = [len(p) for p in self._parent_idx]
+        ptr = np.zeros(len(sizes) + 1, dtype=np.intp)
+        np.cumsum(sizes, out=ptr[1:])
+        flat = np.fromiter((p for parents in self._parent_idx for p in parents),
+                           dtype=np.intp, count=ptr[-1])
+        ptr.setflags(write=False)
+        flat.setflags(write=False)
+        return ptr, flat
+
+    @cached_property
+    def child_csr(self):
+        """
+        Get the children of all nodes in compressed sparse row (CSR) layout,
+        the transpose of `SFM.parent_csr`. The arrays are read-only.
+
+        Returns
+        -------
+        ptr: np.ndarray
+            Offsets of shape (number of nodes + 1,).
+
+        flat: np.ndarray
+            Concatenated child indices; the children of node `SFM.nodes[i]`
+            are `flat[ptr[i]:ptr[i+1]]`, in increasing index order.
+        """
+        parent_ptr, parent_flat = self.parent_csr
+        n = len(self.nodes)
+        # the child of each edge, in the order of parent_flat
+        children = np.repeat(np.arange(n, dtype=np.intp), np.diff(parent_ptr))
+        order = np.argsort(parent_flat, kind="stable")
+        ptr = np.zeros(n + 1, dtype=np.intp)
+        np.cumsum(np.bincount(parent_flat, minlength=n), out=ptr[1:])
+        flat = children[order]
+        ptr.setflags(write=False)
+        flat.setflags(write=False)
+        return ptr, flat
+
+    def assignment_to_array(self, w_total: dict, dtype=None) -> np.ndarray:
+        """
+        Convert a complete {node: value} assignment into an array.
+
+        The i-th entry of the array is the value of the node with integer index i.
+
+        Parameters
+        ----------
+        w_total: dict
+            The complete assignment to be converted.
+
+        dtype: optional
+            Data type of the returned array, inferred from the values by default.
+
+        Returns
+        -------
+        np.ndarray
+            The assignment as an array of shape (number of nodes,).
+        """
+        return np.array([w_total[node] for node in self.nodes], dtype=dtype)
+
+    def array_to_assignment(self, w_arr: np.ndarray) -> dict:
+        """
+        Convert an array of values back into a complete {node: value} assignment.
+
+        This is the inverse of `SFM.assignment_to_array`.
+        """
+        return dict(zip(self.nodes, w_arr.tolist()))
+
+    def _expected_values(self, w_total: dict) -> dict:
+        """
+        Compute the value of each endo-node in w_total from its parents' values.
+
+        If w_total is complete and all its values are real numbers,
+        nodes in `SFM._batch_groups` are evaluated in vectorized batches;
+        all other nodes are evaluated one by one.
+        """
+        expected = {}
+        if self._batch_groups and len(w_total) == len(self.nodes):
+            nodes = self.nodes
+            w_arr = self.assignment_to_array(w_total)
+            # other values (e.g. complex numbers or Fractions) are left
+            # to the structural functions themselves
+            batch_groups = self._batch_groups if w_arr.dtype.kind in "biuf" else ()
+            for node_idx, parent_idx, cls, weights in batch_groups:
+                values = cls.batch_call(weights, w_arr[parent_idx])
+                expected.update(zip([nodes[i] for i in node_idx], values.tolist()))
+        for node in w_total:
+            if node not in expected and self._parents[node]:  # the node has at least 1 parent node
+                # structural functions only read their parents' values,
+                # so there is no need to build a parent assignment per node
+                expected[node] = self.functions[node](w_total)
+        return expected
 
     def satisfied_by(self, w_total: dict) -> bool:
         """
@@ -92,14 +415,8 @@ class SFM:
         # check whether all values are in the domain
         # omitted, this might not be necessary for python programs
 
-        for node, value in w_total.items():
-            if self.graph.in_degree(node) > 0:  # the node has at least 1 parent node
-                # assignment over the parents of the node
-                w_parent = {p: w_total[p] for p in self.graph.predecessors(node)}
-                if value != self.functions[node](w_parent):
-                    # this structural function is not satisfied by the assignment
-                    return False
-        return True
+        # a structural function is not satisfied if the expected value differs
+        return all(w_total[node] == value for node, value in self._expected_values(w_total).items())
 
     def all_violations(self, w_total):
         """
@@ -120,16 +437,10 @@ class SFM:
         and structural function.
 
         """
-        violations = []
-        for node, actual in w_total.items():
-            if self.graph.in_degree(node) > 0:  # the node has at least 1 parent node
-                # assignment over the parents of the node
-                w_parent = {p: w_total[p] for p in self.graph.predecessors(node)}
-                expected = self.functions[node](w_parent)
-                if expected != actual:
-                    # this structural function is not satisfied by the assignment
-                    violations.append((node, expected, actual))
-        return violations
+        expected = self._expected_values(w_total)
+        # this structural function is not satisfied by the assignment
+        return [(node, expected[node], actual) for node, actual in w_total.items()
+                if node in expected and expected[node] != actual]
 
 
 def main():
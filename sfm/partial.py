@@ -3,13 +3,87 @@ Partial inference (vanilla and contrastive)
 
 Useful when the graph is large but the number of affected nodes is small.
 
-Suppose the graph is very big,
-so topological sort isn't worth it.
+The topological order is computed once per SFM and cached,
+so partial inference only collects the targets' ancestors per query
+and evaluates them in that order, instead of sweeping the whole graph.
 """
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
+
+import numpy as np
+
 from sfm.model import SFM
+from sfm.inference import MIN_BATCH_SIZE
+from sfm._util import check_vfi_inputs, choose_batch_plan, exo_array, report
+
+
+def _reachable(ptr, flat, start_ids, within=None):
+    """
+    Find all nodes reachable from the start nodes in a CSR adjacency,
+    optionally only through the nodes in the boolean mask `within`.
+
+    The nodes are found level by level,
+    with vectorized lookups in the CSR arrays (see `SFM.parent_csr`),
+    so the Python overhead is per level rather than per node.
+    With parent CSR arrays, the reachable nodes are the ancestors;
+    with child CSR arrays, they are the descendants.
+
+    Returns
+    -------
+    np.ndarray
+        A boolean mask over all node indices,
+        including the start nodes themselves.
+    """
+    found = np.zeros(len(ptr) - 1, dtype=bool)
+    found[start_ids] = True
+    frontier = np.flatnonzero(found)
+    while frontier.size:
+        start = ptr[frontier]
+        count = ptr[frontier + 1] - start
+        total = count.sum()
+        if not total:
+            break
+        # positions of the neighbors of all frontier nodes in flat
+        offsets = np.repeat(start - np.cumsum(count) + count, count) + np.arange(total)
+        neighbors = flat[offsets]
+        keep = ~found[neighbors]
+        if within is not None:
+            keep &= within[neighbors]
+        neighbors = np.unique(neighbors[keep])
+        found[neighbors] = True
+        frontier = neighbors
+    return found
 
 
-def partial_vfi(sfm: SFM, w_exo: dict, target_nodes: set):
+def _worklist_order(ptr, flat, topo_idx, target_ids):
+    """
+    Get the evaluation order of the target nodes and all their ancestors.
+
+    Parameters
+    ----------
+    ptr, flat: np.ndarray
+        The parent CSR arrays.
+
+    topo_idx: np.ndarray
+        All node indices in topological order.
+
+    target_ids: np.ndarray
+        Integer indices of the target nodes.
+
+    Returns
+    -------
+    np.ndarray
+        Integer indices of the targets and their ancestors, in topological order.
+    """
+    found = _reachable(ptr, flat, target_ids)
+    # the cached topological order restricted to the ancestor set
+    # is a topological order of the induced subgraph,
+    # so no topological sort (e.g. Kahn's algorithm) is run per query
+    return topo_idx[found[topo_idx]]
+
+
+def partial_vfi(sfm: SFM, w_exo: dict, target_nodes: set, *,
+                batched=None, verbose=False, return_stats=False):
     """
     Partial vanilla forward inference
 
@@ -21,45 +95,182 @@ def partial_vfi(sfm: SFM, w_exo: dict, target_nodes: set):
     target_nodes : set
         A set of nodes whose values we want to infer
 
+    batched : bool, optional
+        Whether to evaluate the needed endo-nodes in vectorized batches,
+        the same as in `vfi`.
+        By default, batches are used when they are supported
+        and enough nodes are needed.
+
+    verbose : bool
+        Whether to print the number of evaluated structural functions.
+
+    return_stats : bool
+        Whether to also return evaluation statistics.
+
     Returns
     -------
+    w : dict
+        The values of the target nodes.
 
+    stats : dict
+        Only returned if `return_stats` is True.
+        "evaluations" is the number of evaluated structural functions,
+        and "endo_total" is the number of endo-nodes.
     """
-    target_nodes = set(target_nodes)
-    assert sfm.is_directed_acyclic_graph, \
-        "Forward inference is only allowed in directed acyclic graphs"
-    assert frozenset(w_exo.keys()) == sfm.exo_nodes,\
-        "w_exo must contain all exogenous nodes for vanilla forward inference"
-    assert not target_nodes.difference(sfm.graph.nodes),\
-        "all target nodes should be in the SFM"
+    target_nodes = check_vfi_inputs(sfm, w_exo, target_nodes)
 
+    target_ids = [sfm._idx[u] for u in target_nodes]
+    # the targets and their ancestors
+    needed = _reachable(*sfm.parent_csr, target_ids)
+    # selecting the needed rows of each batch costs about as much again,
+    # so twice as many nodes as in vfi are needed to break even
+    plan = choose_batch_plan(sfm, w_exo, batched, np.count_nonzero(needed), 2 * MIN_BATCH_SIZE)
+    if plan is not None:
+        result, count = _partial_vfi_batched(sfm, w_exo, target_nodes, plan, needed)
+        return report(result, sfm, count, "partial vfi", verbose, return_stats)
     w = w_exo.copy()
-    # perform iterative DFS because DFS reaches root/exo nodes faster
-    stack = list(target_nodes)
+    topo_idx = sfm._topo_idx
+    count = _evaluate_in_order(sfm, w, topo_idx[needed[topo_idx]])
+    return report({u: w[u] for u in target_nodes}, sfm, count, "partial vfi", verbose, return_stats)
+
 
-    COUNT = 0
+def _partial_vfi_batched(sfm: SFM, w_exo: dict, target_nodes, plan: list, needed: np.ndarray):
+    """
+    Partial vanilla forward inference over an array assignment,
+    evaluating only the rows of each batch in the SFM's `_batch_plan`
+    whose nodes are in the boolean mask `needed`.
+
+    Returns the values of the target nodes
+    and the number of evaluated structural functions.
+    """
+    w_arr = exo_array(sfm, w_exo, plan)
+    count = 0
+    for node_idx, parent_idx, cls, weights in plan:
+        rows = needed[node_idx]
+        n_rows = np.count_nonzero(rows)
+        if n_rows == len(rows):
+            w_arr[node_idx] = cls.batch_call(weights, w_arr[parent_idx])
+        elif n_rows:
+            # stacked weights have one row per function
+            weights = tuple(x[rows] for x in weights)
+            w_arr[node_idx[rows]] = cls.batch_call(weights, w_arr[parent_idx[rows]])
+        count += n_rows
+    idx = sfm._idx
+    return {u: w_exo[u] if u in w_exo else w_arr[idx[u]].item() for u in target_nodes}, count
 
-    while stack:
-        node = stack.pop()  # pop a node from the stack
 
+def _evaluate_in_order(sfm: SFM, w: dict, order: np.ndarray):
+    """
+    Evaluate the nodes with the given integer indices in order, in place,
+    skipping nodes that already have a value in w.
+    w must contain all exo-nodes.
+
+    Returns the number of evaluated structural functions.
+    """
+    nodes = sfm.nodes
+    functions = sfm.functions
+    count = 0
+    # evaluate the needed endo-nodes in topological order, each exactly once;
+    # every node in the worklist is a target or precedes one,
+    # so the loop ends right after the last target is computed
+    for i in order.tolist():
+        node = nodes[i]
+        # exo-nodes are always in w, so this is the only check needed
         if node not in w:
-            parent_nodes = sfm.parents(node)  # get parent nodes
-            if parent_nodes:    # is not root node
-                unknown_parents = [p for p in parent_nodes if p not in w]
-                if unknown_parents:  # there are unknown parents
-                    stack.append(node)  # push node back onto the stack
-                    stack.extend(unknown_parents)   # push unknown parents to the stack
-                else:
-                    COUNT += 1
-                    # all parent values are computed
-                    w[node] = sfm.functions[node](w)
-
-    print(f"partial vfi evaluations: {COUNT}/{len(sfm.endo_nodes)}")
-    return {u: w[u] for u in target_nodes}
-
-
-def partial_cfi(sfm: SFM, w0: dict, w1_changed_exo: dict, target_nodes: set):
-    target_nodes = set(target_nodes)
+            count += 1
+            w[node] = functions[node](w)
+    return count
+
+
+# partial_vfi_cached keeps the values of this many exogenous assignments per SFM
+VFI_CACHE_SIZE = 16
+
+# {sfm: OrderedDict({frozenset(w_exo.items()): w})}, in least recently used order;
+# entries go away with their SFM
+_vfi_cache = WeakKeyDictionary()
+
+
+def partial_vfi_cached(sfm: SFM, w_exo: dict, target_nodes: set, *, verbose=False, return_stats=False):
+    """
+    Partial vanilla forward inference that remembers all evaluated nodes.
+
+    Repeated queries with the same SFM and exogenous assignment
+    only evaluate the nodes that no earlier query has computed,
+    e.g. when the same assignment is queried for different targets.
+    The values of the last `VFI_CACHE_SIZE` exogenous assignments are kept.
+
+    Since the SFM is assumed to be immutable, the cache is never invalidated,
+    and all exogenous values must be hashable.
+
+    Parameters
+    ----------
+    sfm
+    w_exo
+
+    target_nodes : set
+        A set of nodes whose values we want to infer
+
+    verbose, return_stats : bool
+        The same as in `partial_vfi`;
+        nodes found in the cache don't count as evaluations.
+
+    Returns
+    -------
+    dict
+        The values of the target nodes, the same as `partial_vfi`,
+        followed by the statistics if `return_stats` is True.
+    """
+    target_nodes = check_vfi_inputs(sfm, w_exo, target_nodes)
+
+    cache = _vfi_cache.get(sfm)
+    if cache is None:
+        cache = _vfi_cache[sfm] = OrderedDict()
+    # values that compare equal but differ in type (1, 1.0, True) or sign (0.0, -0.0)
+    # can give different results, so the type and sign are part of the key
+    key = frozenset((u, type(v), repr(v) if isinstance(v, float) else v) for u, v in w_exo.items())
+    w = cache.get(key)
+    if w is None:
+        w = cache[key] = w_exo.copy()
+        if len(cache) > VFI_CACHE_SIZE:
+            cache.popitem(last=False)
+    else:
+        cache.move_to_end(key)
+    missing = [sfm._idx[u] for u in target_nodes if u not in w]
+    count = 0
+    if missing:
+        ptr, flat = sfm.parent_csr
+        count = _evaluate_in_order(sfm, w, _worklist_order(ptr, flat, sfm._topo_idx, missing))
+    return report({u: w[u] for u in target_nodes}, sfm, count, "partial vfi (cached)", verbose, return_stats)
+
+
+def partial_cfi(sfm: SFM, w0: dict, w1_changed_exo: dict, target_nodes: set, *,
+                verbose=False, return_stats=False):
+    """
+    Partial contrastive forward inference
+
+    Parameters
+    ----------
+    sfm
+    w0 : dict
+        The reference assignment over all nodes.
+
+    w1_changed_exo : dict
+        The new values of some exo-nodes.
+
+    target_nodes : set
+        A set of nodes whose values we want to infer
+
+    verbose, return_stats : bool
+        The same as in `partial_vfi`.
+
+    Returns
+    -------
+    w1 : dict
+        The values of the target nodes,
+        followed by the statistics if `return_stats` is True.
+    """
+    if not isinstance(target_nodes, (set, frozenset)):
+        target_nodes = set(target_nodes)
     assert sfm.is_directed_acyclic_graph, \
         "Forward inference is only allowed in directed acyclic graphs"
     if any(not sfm.is_exo_node(u) for u in w1_changed_exo):
@@ -67,47 +278,59 @@ def partial_cfi(sfm: SFM, w0: dict, w1_changed_exo: dict, target_nodes: set):
     if any(not sfm.graph.has_node(u) for u in target_nodes):
         raise ValueError("all target nodes should be in the SFM")
 
-    # changed[u]==True means changed (confirmed)
-    # changed[u]==False means not changed
-    # u not in changed means we don't know
-    changed = {u: w1_changed_exo[u] != w0[u] for u in w1_changed_exo}
-    w1_c = {u: w1_changed_exo[u] for u in w1_changed_exo if changed[u]}
-
-    stack = list(target_nodes)
-
-    COUNT = 0
-
-    while stack:
-        node = stack.pop()  # Pop a node from the stack
-        if node not in changed:     # don't know
-            if sfm.is_exo_node(node):
-                # all changed exo-nodes have been initialized in the beginning
-                changed[node] = False
-            else:
-                unknown_parents = [p for p in sfm.parents(node) if p not in changed]
-                if unknown_parents:
-                    stack.append(node)
-                    stack.extend(unknown_parents)
-                else:
-                    w_parents = {}
-                    any_parent_changed = False
-                    for p in sfm.parents(node):
-                        if changed[p]:
-                            any_parent_changed = True
-                            w_parents[p] = w1_c[p]
-                        else:
-                            w_parents[p] = w0[p]
-                    if any_parent_changed:
-                        COUNT += 1
-                        value = sfm.functions[node](w_parents)
-                        if value != w0[node]:
-                            changed[node] = True
-                            w1_c[node] = value
-                        else:
-                            changed[node] = False
-                    else:
-                        # same parents, same child
-                        changed[node] = False
-    print(f"partial cfi evaluations: {COUNT}/{len(sfm.endo_nodes)}")
-    return {u: w1_c[u] if changed[u] else w0[u] for u in target_nodes}
+    # bind to locals once, instead of attribute lookups and method calls per visit;
+    # parent indices are computed once per SFM, not per visit
+    nodes = sfm.nodes
+    idx = sfm._idx
+    parent_idx = sfm._parent_idx
+    positional_functions = sfm._positional_functions
+    # changed[i] == 1 iff the value of the node with index i changes;
+    # integer indexing needs no hashing, unlike a dict keyed by node
+    changed = bytearray(len(nodes))
+    # w1_c holds the new values of the changed nodes only;
+    # exo-nodes whose new value equals the reference are skipped in the same pass
+    w1_c = {}
+    changed_ids = []
+    for u, value in w1_changed_exo.items():
+        if value != w0[u]:
+            w1_c[u] = value
+            i = idx[u]
+            changed[i] = 1
+            changed_ids.append(i)
+
+    count = 0
+
+    # only the descendants of changed exo-nodes can change,
+    # so visit the targets' ancestors among them in topological order;
+    # all other nodes keep their values in w0 without being visited
+    if not changed_ids:
+        return report({u: w0[u] for u in target_nodes}, sfm, 0, "partial cfi", verbose, return_stats)
+    topo_idx = sfm._topo_idx
+    ancestors = _reachable(*sfm.parent_csr, [idx[u] for u in target_nodes])
+    # a changed exo-node that is not an ancestor of any target is irrelevant
+    changed_ids = [i for i in changed_ids if ancestors[i]]
+    needed = _reachable(*sfm.child_csr, changed_ids, within=ancestors)
+    # all parents of a node are known when it is visited,
+    # so no node is pushed back to wait for its parents
+    for i in topo_idx[needed[topo_idx]].tolist():
+        if changed[i]:
+            # the changed exo-nodes have been initialized in the beginning
+            continue
+        for p in parent_idx[i]:
+            if changed[p]:
+                break
+        else:
+            # same parents, same child
+            continue
+        # only gather the parent values if the node is evaluated,
+        # as a list in the order the function expects
+        node = nodes[i]
+        arg_nodes, f = positional_functions[node]
+        count += 1
+        value = f([w1_c[p] if p in w1_c else w0[p] for p in arg_nodes])
+        if value != w0[node]:
+            changed[i] = 1
+            w1_c[node] = value
+    result = {u: w1_c[u] if u in w1_c else w0[u] for u in target_nodes}
+    return report(result, sfm, count, "partial cfi", verbose, return_stats)
 
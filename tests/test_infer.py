@@ -1,13 +1,32 @@
 import unittest
+import pickle
+from fractions import Fraction
 from functools import partial
 import numpy as np
-from sfm.generate import RandomSFM, RandomLinear, RandomCongruence, plot_dag
+from sfm.model import SFM
+from sfm.generate import RandomSFM, RandomLinear, RandomQuadratic, RandomCongruence, plot_dag
 from sfm.inference import delta_encode, delta_decode,\
-    vfi, cfi
-from sfm.partial import partial_vfi, partial_cfi
+    delta_encode_arr, delta_decode_arr, vfi, cfi
+from sfm.partial import partial_vfi, partial_vfi_cached, partial_cfi
 
 
 class MyTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # random SFMs and their reference assignments, built once and shared by
+        # the partial inference tests, so these tests mostly spend time in inference
+        cls.linear_cases = []
+        for test_case in range(10):
+            sfm = RandomSFM(20, 0.5, RandomLinear)
+            w_exo = {u: np.random.randn() for u in sfm.exo_nodes}
+            cls.linear_cases.append((sfm, w_exo, vfi(sfm, w_exo)))
+        cls.congruence_mod = 5
+        cls.congruence_cases = []
+        for test_case in range(50):
+            sfm = RandomSFM(20, 0.2, partial(RandomCongruence, m=cls.congruence_mod))
+            w0_exo = {u: int(np.random.randint(0, cls.congruence_mod)) for u in sfm.exo_nodes}
+            cls.congruence_cases.append((sfm, w0_exo, vfi(sfm, w0_exo)))
+
     def test_delta_compression(self):
         num_nodes = 10
         num_cases = 10
@@ -26,6 +45,88 @@ class MyTestCase(unittest.TestCase):
             self.assertEqual(delta_decode(delta_encode(d2, w0=d1), w0=d1), d2)
             self.assertEqual(delta_decode(delta_encode(d1, w0=d2), w0=d2), d1)
 
+    def test_delta_compression_arr(self):
+        num_nodes = 10
+        num_cases = 10
+        for test_case in range(num_cases):
+            w0, w1 = np.random.rand(2, num_nodes)
+            mask = np.random.rand(num_nodes) > 0.5
+            w1[mask] = w0[mask]
+            idx, vals = delta_encode_arr(w1, w0)
+            self.assertEqual(len(idx), sum(~mask))
+            self.assertTrue(np.array_equal(delta_decode_arr(idx, vals, w0), w1))
+
+    def test_assignment_array(self):
+        sfm = RandomSFM(20, 0.5, RandomLinear)
+        w_exo = {u: np.random.randn() for u in sfm.exo_nodes}
+        w = vfi(sfm, w_exo)
+        w_arr = sfm.assignment_to_array(w)
+        self.assertEqual(w_arr.shape, (20,))
+        # conversion to array and back should be lossless
+        self.assertEqual(sfm.array_to_assignment(w_arr), w)
+
+    def test_unrolled_functions(self):
+        # generated code for small fan-in must match the generic scalar path exactly
+        for n in range(6):
+            w = {u: np.random.randn() for u in range(n)}
+            w_int = {u: int(np.random.randint(0, 5)) for u in range(n)}
+            for f, w in (RandomLinear(range(n)), w), (RandomQuadratic(range(n)), w), \
+                    (RandomCongruence(range(n), m=5), w_int):
+                x = [w[u] for u in f.nodes]
+                expected = f(w)
+                self.assertEqual(expected, f.call_args(x))
+                # generated code is rebuilt after unpickling
+                self.assertEqual(expected, pickle.loads(pickle.dumps(f))(w))
+                self.assertEqual(expected, pickle.loads(pickle.dumps(f)).call_args(x))
+                f._unrolled = f._unrolled_args = None
+                self.assertEqual(expected, f(w))
+                self.assertEqual(expected, f.call_args(x))
+
+    def test_call_args(self):
+        # positional evaluation must match dict evaluation exactly
+        for n in [0, 1, 3, 5, 10]:
+            w = {u: int(np.random.randint(0, 5)) for u in range(n)}
+            for f in RandomLinear(range(n)), RandomQuadratic(range(n)), RandomCongruence(range(n), m=5):
+                self.assertEqual(f(w), f.call_args([w[u] for u in f.nodes]))
+
+    def test_congruence_large_fanin(self):
+        # the int64 path for a large fan-in must match exact Python arithmetic
+        from sfm.generate import LARGE_FANIN
+        m = 7
+        n = LARGE_FANIN + 88
+        f = RandomCongruence(range(n), m=m)
+        for x in ([int(v) for v in np.random.randint(-10 ** 6, 10 ** 6, size=n)],
+                  [2 ** 70] + [1] * (n - 1),
+                  [-2 ** 70] + [3] * (n - 1),
+                  [1.5] + [1] * (n - 1)):
+            expected = (sum(a * v for a, v in zip(f.a, x)) + f.c) % m
+            self.assertEqual(expected, f.call_args(x))
+            self.assertEqual(expected, f(dict(zip(f.nodes, x))))
+
+    def test_congruence_large_weights(self):
+        # weights outside [0, m) must not overflow the int64 paths
+        m = 5
+        x = [3, 4, 2]
+        for a in ([2 ** 62] * 3, [2 ** 70] * 3, [-1, -2 ** 63, 7]):
+            f = RandomCongruence(range(3), m=m, a=a, c=2 ** 64)
+            expected = (sum(ai * v for ai, v in zip(a, x)) + 2 ** 64) % m
+            self.assertEqual(expected, f.call_args(x))
+            out = RandomCongruence.batch_call(RandomCongruence.stack([f]), np.array([x]))
+            self.assertEqual(expected, out[0])
+
+    def test_partial_cfi_dict_functions(self):
+        # structural functions without call_args are called with a parent dict
+        m = 5
+        for test_case in range(10):
+            sfm = RandomSFM(20, 0.2, partial(RandomCongruence, m=m))
+            sfm = SFM(sfm.graph, sfm.domains, {u: (lambda w, f=f: f(w)) for u, f in sfm.functions.items()})
+            w0_exo = {u: int(np.random.randint(0, m)) for u in sfm.exo_nodes}
+            w1_exo = self.tweak_exo(w0_exo, prob_changed_exo=0.5, congruence_mod=m)
+            w0 = vfi(sfm, w0_exo)
+            w1 = vfi(sfm, w1_exo)
+            w1t = partial_cfi(sfm, w0=w0, w1_changed_exo=w1_exo, target_nodes=sfm.graph.nodes)
+            self.assertEqual(w1, w1t)
+
     def test_vfi(self):
         n_cases = 10
         for test_case in range(n_cases):
@@ -34,6 +135,52 @@ class MyTestCase(unittest.TestCase):
             w = vfi(sfm, w_exo)
             self.assertTrue(sfm.satisfied_by(w))
 
+    def test_vfi_batched(self):
+        n_cases = 10
+        m = 5
+        for test_case in range(n_cases):
+            sfm = RandomSFM(20, 0.5, RandomLinear)
+            w_exo = {u: np.random.randn() for u in sfm.exo_nodes}
+            # batched evaluation must match node-by-node evaluation exactly
+            w = vfi(sfm, w_exo, batched=True)
+            self.assertEqual(w, vfi(sfm, w_exo, batched=False))
+            self.assertTrue(sfm.satisfied_by(w))
+            # same for integer congruences
+            sfm = RandomSFM(20, 0.5, partial(RandomCongruence, m=m))
+            w_exo = {u: int(np.random.randint(0, m)) for u in sfm.exo_nodes}
+            w = vfi(sfm, w_exo, batched=True)
+            self.assertEqual(w, vfi(sfm, w_exo, batched=False))
+            self.assertTrue(sfm.satisfied_by(w))
+            # and for congruences of float values, which are not reduced first
+            w_exo = {u: np.random.randint(0, m) + np.random.rand() for u in sfm.exo_nodes}
+            w = vfi(sfm, w_exo, batched=True)
+            self.assertEqual(w, vfi(sfm, w_exo, batched=False))
+            self.assertTrue(sfm.satisfied_by(w))
+        # by default, a model large enough for batches
+        # still evaluates complex values node by node
+        sfm = RandomSFM(1000, 0.005, RandomLinear)
+        w_exo = {u: complex(np.random.randn(), np.random.randn()) for u in sfm.exo_nodes}
+        w = vfi(sfm, w_exo)
+        self.assertEqual(w, vfi(sfm, w_exo, batched=False))
+        self.assertTrue(sfm.satisfied_by(w))
+
+    def test_all_violations(self):
+        sfm = RandomSFM(20, 0.5, RandomLinear)
+        w_exo = {u: np.random.randn() for u in sfm.exo_nodes}
+        w = vfi(sfm, w_exo)
+        self.assertEqual(sfm.all_violations(w), [])
+        # perturb one endo-node so its own structural function is violated
+        node = next(iter(sfm.endo_nodes))
+        w[node] += 1.0
+        self.assertFalse(sfm.satisfied_by(w))
+        self.assertIn(node, [u for u, expected, actual in sfm.all_violations(w)])
+        # values that can't be batched are checked node by node
+        for w_exo in ({u: complex(np.random.randn(), 1.0) for u in sfm.exo_nodes},
+                      {u: Fraction(int(np.random.randint(-9, 9)), 7) for u in sfm.exo_nodes}):
+            w = vfi(sfm, w_exo, batched=False)
+            self.assertTrue(sfm.satisfied_by(w))
+            self.assertEqual(sfm.all_violations(w), [])
+
     def test_cfi(self):
         n_cases = 10
         m = 5   # use congruence for non-injective functions
@@ -63,21 +210,81 @@ class MyTestCase(unittest.TestCase):
 
     def test_partial_vfi(self):
         # to test partial forward inference, the ground truth is generated by total forward inference
-        n_cases = 10
         n_nodes = 20
-        for test_case in range(n_cases):
-            sfm = RandomSFM(n_nodes, 0.5, RandomLinear)
-            w_exo = {u: np.random.randn() for u in sfm.exo_nodes}
-            w_total = vfi(sfm, w_exo)
+        for sfm, w_exo, w_total in self.linear_cases:
             # prepare partial inference
             target_size = np.random.randint(1, n_nodes + 1)
-            print(f"{target_size=}")
             targets = np.random.choice(sfm.graph.nodes, size=target_size, replace=False)
             # ground truth w_partial
             expected = {u: w_total[u] for u in targets}
             actual = partial_vfi(sfm, w_exo=w_exo, target_nodes=targets)
             self.assertEqual(expected, actual)
 
+    def test_worklist_order(self):
+        import networkx as nx
+        from sfm.partial import _worklist_order
+        sfm = RandomSFM(50, 0.1, RandomLinear)
+        ptr, flat = sfm.parent_csr
+        for test_case in range(10):
+            targets = np.random.choice(len(sfm.nodes), size=np.random.randint(1, 10), replace=False)
+            order = [sfm.nodes[i] for i in _worklist_order(ptr, flat, sfm._topo_idx, targets).tolist()]
+            # exactly the targets and their ancestors
+            expected = {sfm.nodes[i] for i in targets}
+            for i in targets:
+                expected |= nx.ancestors(sfm.graph, sfm.nodes[i])
+            self.assertEqual(set(order), expected)
+            self.assertEqual(len(order), len(expected))
+            # every node comes after its parents
+            pos = {u: k for k, u in enumerate(order)}
+            self.assertTrue(all(pos[p] < pos[u] for u in order for p in sfm.parents(u)))
+
+    def test_return_stats(self):
+        sfm = RandomSFM(20, 0.5, RandomLinear)
+        w_exo = {u: np.random.randn() for u in sfm.exo_nodes}
+        w, stats = partial_vfi(sfm, w_exo=w_exo, target_nodes=sfm.graph.nodes, return_stats=True)
+        self.assertEqual(w, vfi(sfm, w_exo))
+        # all endo-nodes are evaluated exactly once
+        self.assertEqual(stats, {"evaluations": len(sfm.endo_nodes), "endo_total": len(sfm.endo_nodes)})
+        # nothing is evaluated if no exo-node changes
+        w1, stats = cfi(sfm, w0=w, w1_changed_exo={}, return_stats=True)
+        self.assertEqual(w1, w)
+        self.assertEqual(stats["evaluations"], 0)
+
+    def test_partial_vfi_batched(self):
+        m = 5
+        for test_case in range(10):
+            linear = RandomSFM(20, 0.3, RandomLinear)
+            congruence = RandomSFM(20, 0.3, partial(RandomCongruence, m=m))
+            for sfm, w_exo in [(linear, {u: np.random.randn() for u in linear.exo_nodes}),
+                               (congruence, {u: int(np.random.randint(0, m)) for u in congruence.exo_nodes})]:
+                targets = np.random.choice(sfm.graph.nodes, size=np.random.randint(1, 21), replace=False)
+                # evaluating selected rows of batches must match node-by-node evaluation exactly
+                self.assertEqual(partial_vfi(sfm, w_exo=w_exo, target_nodes=targets, batched=False),
+                                 partial_vfi(sfm, w_exo=w_exo, target_nodes=targets, batched=True))
+
+    def test_partial_vfi_cached(self):
+        sfm = RandomSFM(20, 0.5, RandomLinear)
+        w_exo = {u: np.random.randn() for u in sfm.exo_nodes}
+        w_total = vfi(sfm, w_exo)
+        # later queries reuse the values computed by earlier ones
+        for test_case in range(10):
+            targets = np.random.choice(sfm.graph.nodes, size=np.random.randint(1, 21), replace=False)
+            expected = {u: w_total[u] for u in targets}
+            self.assertEqual(expected, partial_vfi_cached(sfm, w_exo=w_exo, target_nodes=targets))
+        # a repeated query evaluates nothing
+        w, stats = partial_vfi_cached(sfm, w_exo=w_exo, target_nodes=sfm.graph.nodes, return_stats=True)
+        self.assertEqual(w, w_total)
+        w, stats = partial_vfi_cached(sfm, w_exo=w_exo, target_nodes=sfm.graph.nodes, return_stats=True)
+        self.assertEqual(w, w_total)
+        self.assertEqual(stats["evaluations"], 0)
+
+    def test_partial_vfi_cached_key(self):
+        # values that compare equal but differ in type or sign are cached separately
+        import networkx as nx
+        sfm = SFM(nx.DiGraph([(0, 1)]), {}, {1: lambda w: (type(w[0]).__name__, str(w[0]))})
+        for value in [1, 1.0, True, 0.0, -0.0, 0, False]:
+            self.assertEqual(partial_vfi_cached(sfm, {0: value}, {1}), partial_vfi(sfm, {0: value}, {1}))
+
     @staticmethod
     def tweak_exo(w0_exo: dict, prob_changed_exo: float, congruence_mod: int):
         # change some exo-nodes' values
@@ -104,20 +311,41 @@ class MyTestCase(unittest.TestCase):
             from sfm.generate import random_dag
             self.assertEqual(len(random_dag(n, p).nodes), n)
 
+    def test_random_graph_fast(self):
+        import networkx as nx
+        from sfm.generate import random_dag_fast
+        for i in range(100):
+            n = np.random.randint(0, 100)
+            p = np.random.choice([0., 1., np.random.rand() * 0.2, np.random.rand()])
+            G = random_dag_fast(n, p)
+            self.assertEqual(len(G.nodes), n)
+            self.assertTrue(nx.is_directed_acyclic_graph(G))
+            if p == 0:
+                self.assertEqual(len(G.edges), 0)
+            elif p == 1:
+                self.assertEqual(len(G.edges), n * (n - 1) // 2)
+
+    def test_random_sfm_subclass(self):
+        # a subclass with its own constructor is called once per node,
+        # not through the inherited random_batch
+        class UnitLinear(RandomLinear):
+            def __init__(self, nodes):
+                super().__init__(nodes, a=np.ones(len(nodes)), b=0.0)
+
+        sfm = RandomSFM(20, 0.5, UnitLinear)
+        w = vfi(sfm, {u: 1.0 for u in sfm.exo_nodes})
+        self.assertTrue(sfm.satisfied_by(w))
+        for u in sfm.endo_nodes:
+            self.assertEqual(w[u], sum(w[p] for p in sfm.parents(u)))
+
     def test_partial_cfi_1(self):
-        n_cases = 50
-        m = 5   # congruence mod
+        m = self.congruence_mod
         prob_changed_exo = 0.5
         n_nodes = 20
-        p = 0.2
-        for test_case in range(n_cases):
-            print("-" * 50)
-            sfm = RandomSFM(n_nodes, p, partial(RandomCongruence, m=m))
-            w0_exo = {u: int(np.random.randint(0, m)) for u in sfm.exo_nodes}
+        for sfm, w0_exo, w0 in self.congruence_cases:
             w1_exo = self.tweak_exo(w0_exo, prob_changed_exo=prob_changed_exo, congruence_mod=m)
             w1_changed_exo = delta_encode(w1=w1_exo, w0=w0_exo)
 
-            w0 = vfi(sfm, w0_exo)
             # ground truth using vanilla forward inference
             w1_vfi = vfi(sfm, w1_exo)
             # result from contrastive forward inference
@@ -130,7 +358,6 @@ class MyTestCase(unittest.TestCase):
 
             # select targets of interest
             target_size = np.random.randint(1, n_nodes + 1)
-            print(f"target size: {target_size}/{sfm.graph.number_of_nodes()}")
             targets = np.random.choice(sfm.graph.nodes, size=target_size, replace=False)
             # ground truth w_targets
             w1t_vfi = {u: w1_vfi[u] for u in targets}